@@ -47,6 +47,14 @@ class RelTimeSpecImplicit:
     def compare(self, o: 'RelTimeSpecImplicit') -> TimeRelativity:
         return NotImplemented
 
+    def sort_key(self) -> tuple:
+        '''
+        A key consistent with `compare`, whose first element is the coarsest unit (e.g. the date): markers are ordered by it first.
+        A key of that element alone is more general than, and unordered against, the other keys sharing it (e.g. a date and a datetime on that day).
+        Longer keys sharing it are ordered as tuples, and equal keys are unordered.
+        '''
+        return NotImplemented
+
 
 class RelTimeSpec:
     '''
@@ -87,6 +95,9 @@ class AbsoluteDateTime(RelTimeMarker, RelTimeSpecImplicit):
     def __str__(self):
         return str(self.abstime)
 
+    def sort_key(self) -> tuple:
+        return (self.abstime.date(), self.abstime.time())
+
     def compare(self, o: RelTimeSpecImplicit) -> TimeRelativity:
         if isinstance(o, AbsoluteDateTime):
             if self.abstime < o.abstime:
@@ -119,6 +130,9 @@ class Date(RelTimeMarker, RelTimeSpecImplicit):
     def __str__(self):
         return str(self.date)
 
+    def sort_key(self) -> tuple:
+        return (self.date,)
+
     def compare(self, o: RelTimeSpecImplicit) -> TimeRelativity:
         if isinstance(o, AbsoluteDateTime):
             o_date = o.abstime.date()
@@ -11,13 +11,17 @@ This module contains all that is related to storage and backend data structures.
 It may be split in the future.
 '''
 
+import ijson
 import itertools
-import json
 import networkx as nx
+import orjson
+import os
 import pathlib
 import uuid
 
-from typing import Dict, Iterable, List, Mapping, Optional, Set, Union
+from collections import defaultdict
+from functools import lru_cache
+from typing import Any, DefaultDict, Dict, Iterable, List, Mapping, Optional, Set, Tuple, Union, cast
 from uuid import UUID
 
 import sede
@@ -32,7 +36,6 @@ from model import (
         Event,
         RelTimeMarker,
         RelTimeSpecImplicit,
-        TimeRelativity,
         )
 
 
@@ -56,41 +59,58 @@ M_T_SER = {
         }
 
 
+@lru_cache(maxsize=1024)
+def _to_uuid(id: str) -> UUID:
+    return UUID(id)
+
+
 class Collection:
 
     def __init__(self, initial_rel_markers: Iterable[RelTimeMarker]=[]):
         self.collection = {}  # type: Dict[UUID, RelTimeMarker]
-        self._dangling_refs = {}  # type: Dict[UUID, Set[UUID]]
+        self._by_type = {}  # type: Dict[type, Dict[UUID, RelTimeMarker]]  # `collection` partitioned by the exact type of items
+        self._dangling_refs = defaultdict(set)  # type: DefaultDict[UUID, Set[UUID]]
+        self._refs_by_item = defaultdict(set)  # type: DefaultDict[UUID, Set[UUID]]  # Reverse index of `_dangling_refs`
         self.add_item(*initial_rel_markers)
 
     def _do_dangling_ref(self, timespec, item_id):
-        for tid in itertools.chain(timespec.befores or [], timespec.sames or [], timespec.afters or []):
+        for tid in itertools.chain(timespec.befores or (), timespec.sames or (), timespec.afters or ()):
             if tid in self.collection:
                 continue
-            if tid not in self._dangling_refs: self._dangling_refs[tid] = set()
             self._dangling_refs[tid].add(item_id)
+            self._refs_by_item[item_id].add(tid)
 
     def add_item(self, *item: RelTimeMarker) -> None:
+        new_ids = [s_item.id for s_item in item]
+        if len(set(new_ids)) != len(new_ids) or any(iid in self.collection for iid in new_ids):
+            raise IllegalStateError('The item you are trying to add has duplicated id with an existing entry or another new item.')
         for s_item in item:
             iid = s_item.id
-            if iid in self.collection:
-                raise IllegalStateError('The item you are trying to add has duplicated id with an existing entry.')
             self.collection[iid] = s_item
-        for s_item in item:
-            iid = s_item.id
+            self._by_type.setdefault(type(s_item), {})[iid] = s_item
+            # Any item resolves references to it, including those made earlier in this batch
+            if iid in self._dangling_refs:
+                for referrer in self._dangling_refs.pop(iid):
+                    tids = self._refs_by_item[referrer]
+                    tids.discard(iid)
+                    if not tids:
+                        del self._refs_by_item[referrer]
             if isinstance(s_item, Event):
-                if iid in self._dangling_refs:
-                    del self._dangling_refs[iid]
                 self._do_dangling_ref(s_item.timespec, iid)
 
     def update_item(self, item_id: Union[UUID, str], new_item: RelTimeMarker) -> None:
         if not isinstance(item_id, UUID):
-            item_id = UUID(item_id)
+            item_id = _to_uuid(item_id)
         old_item = self.get_item(item_id)
         assert isinstance(new_item, type(old_item))
         self.collection[old_item.id] = new_item
-        for iids in self._dangling_refs.values():
+        del self._by_type[type(old_item)][old_item.id]
+        self._by_type.setdefault(type(new_item), {})[old_item.id] = new_item
+        for tid in self._refs_by_item.pop(item_id, ()):
+            iids = self._dangling_refs[tid]
             iids.discard(item_id)
+            if not iids:
+                del self._dangling_refs[tid]
         if isinstance(new_item, Event):
             self._do_dangling_ref(new_item.timespec, item_id)
 
@@ -102,7 +122,7 @@ class Collection:
 
     def get_item(self, id: Union[UUID, str]) -> RelTimeMarker:
         if not isinstance(id, UUID):
-            id = UUID(id)
+            id = _to_uuid(id)
         return self.collection[id]
 
     def get_event(self, id: Union[UUID, str]) -> Event:
@@ -114,12 +134,19 @@ class Collection:
     def list(self) -> Iterable[UUID]:
         return self.collection.keys()
 
+    def by_type(self) -> Mapping[type, Mapping[UUID, RelTimeMarker]]:
+        '''
+        The items grouped by their exact type, for bulk operations that dispatch on it.
+        '''
+        return self._by_type
+
     def has_no_conflict(self) -> bool:
+        ordered_events = OrderedMarkers(self)
         try:
-            return not bool(self.conflicts())
-        except nx.NetworkXUnfeasible:
-            return False
-        return True
+            nx.find_cycle(ordered_events.g, orientation='original')
+        except nx.NetworkXNoCycle:
+            return True
+        return False
 
     def conflicts(self):
         ordered_events = OrderedMarkers(self)
@@ -132,75 +159,94 @@ class Collection:
 
 class OrderedMarkers:
     def __init__(self, collection: Collection):
-        g = nx.DiGraph()
+        edges = []  # type: List[Tuple[str, str]]
 
         # 並查集建立
-        def current_root(node):
-            if id_merging[node] == node: return node
-            return current_root(id_merging[node])
-        coll = collection.collection.values()
-        id_merging = {}  # k:v <==> event ID : the event ID to a parent node of its group
-        for marker in coll:
-            id_merging[marker.id] = marker.id
-        for marker in coll:
-            if isinstance(marker, Event):
-                sames = marker.timespec.sames
-                if sames:
-                    merged_id = None
-                    for same in sames:
-                        if id_merging[same] != same:
-                            merged_id = id_merging[same]
-                            break
-                    if merged_id:
-                        for same in sames:
-                            root = current_root(same)
-                            id_merging[same] = merged_id
-                        id_merging[marker.id] = merged_id
-        id_merged = {}
-        for marker in coll:
-            id_merged[marker.id] = current_root(marker.id)
+        def find(node):
+            root = node
+            while parent[root] != root:
+                root = parent[root]
+            while parent[node] != root:
+                parent[node], node = root, parent[node]
+            return root
+        def union(a, b):
+            ra = find(a)
+            rb = find(b)
+            if ra == rb: return
+            if rank[ra] < rank[rb]:
+                ra, rb = rb, ra
+            parent[rb] = ra
+            if rank[ra] == rank[rb]:
+                rank[ra] += 1
+        by_type = collection.by_type().items()
+        events = cast(List[Event], [marker for t, bucket in by_type if issubclass(t, Event) for marker in bucket.values()])
+        # Implicit markers are both RelTimeMarker and RelTimeSpecImplicit, which the type system can't express here
+        implicits = cast(List[Any], [marker for t, bucket in by_type if issubclass(t, RelTimeSpecImplicit) for marker in bucket.values()])
+        parent = {mid: mid for mid in collection.collection}  # k:v <==> event ID : the event ID to a parent node of its group
+        rank = dict.fromkeys(parent, 0)  # k:v <==> event ID : upper bound of the height of the tree rooted at it
+        for event in events:
+            sames = event.timespec.sames
+            if sames:
+                for same in sames:
+                    union(event.id, same)
+        id_merged = {mid: str(find(mid)) for mid in parent}  # k:v <==> event ID : node ID of its group in the graph
         # 並查集建立完畢
 
-        implicits = []
-        for marker in coll:
-            if isinstance(marker, RelTimeSpecImplicit):
-                implicits.append(marker)
-        implicit_befores = {}
-        implicit_afters = {}
-        for marker in implicits:
-            befores = []
-            afters = []
-            for m2 in implicits:
-                if marker is not m2:
-                    rel = marker.compare(m2)
-                    if rel == TimeRelativity.BEFORE:
-                        befores.append(m2.id)
-                        g.add_edge(marker.id, m2.id)
-                    elif rel == TimeRelativity.AFTER:
-                        afters.append(m2.id)
-                        g.add_edge(m2.id, marker.id)
-            implicit_befores[marker.id] = befores
-            implicit_afters[marker.id] = afters
-
-
-        for marker in coll:
-            if isinstance(marker, Event):
-                node_id_1 = str(id_merged[marker.id])
-                afters = marker.timespec.afters
-                if afters:
-                    for after in afters:
-                        node_id_2 = str(id_merged[after])
-                        g.add_edge(node_id_2, node_id_1)
-                befores = marker.timespec.befores
-                if befores:
-                    for before in befores:
-                        node_id_2 = str(id_merged[before])
-                        g.add_edge(node_id_1, node_id_2)
+        # Markers with different leading keys are strictly ordered, so only neighbouring groups need linking.
+        # Inside a group, markers keyed by the leading key alone are unordered against the rest of the group,
+        # while the others are totally ordered, so only neighbouring tiers of equal keys need linking.
+        keyed = sorted(((m.sort_key(), id_merged[m.id]) for m in implicits), key=lambda kn: kn[0])
+        prev_lasts = []  # type: List[str]
+        for _, grouped in itertools.groupby(keyed, key=lambda kn: kn[0][0]):
+            generals = []  # type: List[str]
+            tiers = []  # type: List[List[str]]
+            for key, tier in itertools.groupby(grouped, key=lambda kn: kn[0]):
+                nodes = [n for _, n in tier]
+                if len(key) == 1:
+                    generals.extend(nodes)
+                else:
+                    tiers.append(nodes)
+            for earlier, later in zip(tiers, tiers[1:]):
+                for n1 in earlier:
+                    for n2 in later:
+                        edges.append((n1, n2))
+            firsts = generals + tiers[0] if tiers else generals
+            for last in prev_lasts:
+                for first in firsts:
+                    edges.append((last, first))
+            prev_lasts = generals + tiers[-1] if tiers else generals
+
+        for event in events:
+            node_id_1 = id_merged[event.id]
+            afters = event.timespec.afters
+            if afters:
+                for after in afters:
+                    node_id_2 = id_merged[after]
+                    edges.append((node_id_2, node_id_1))
+            befores = event.timespec.befores
+            if befores:
+                for before in befores:
+                    node_id_2 = id_merged[before]
+                    edges.append((node_id_1, node_id_2))
 
+        g = nx.DiGraph()
+        g.add_edges_from(edges)
         self.g = g
 
     def cycles(self):
-        return list(nx.simple_cycles(self.g))
+        g = self.g
+        if nx.is_directed_acyclic_graph(g):
+            return []
+        cycles = [[node] for node in nx.nodes_with_selfloops(g)]
+        if cycles:
+            g = g.copy()
+            g.remove_edges_from(nx.selfloop_edges(g))
+        # Without self-loops, only non-trivial strongly connected components may contain cycles
+        for scc in nx.strongly_connected_components(g):
+            if len(scc) == 1:
+                continue
+            cycles.extend(nx.simple_cycles(g.subgraph(scc)))
+        return cycles
 
 
 class InfoRecDB:
@@ -210,19 +256,26 @@ class InfoRecDB:
         path = pathlib.Path(dir_path)
         if not path.exists(): return True
         if not path.is_dir(): return False
-        subs = list(path.glob('*'))
-        return not bool(subs)
+        return next(path.iterdir(), None) is None
 
     @staticmethod
-    def read_db(directory):
+    def read_db(directory, stream=False):
+        '''
+        Read the collection from the DB file in `directory`.
+        The whole file is parsed at once, unless `stream` is set, where entries are parsed one by one to keep memory low for very large DBs.
+        '''
         path = pathlib.Path(directory) / DATABASE_FILE
-        with open(path, 'r') as f:
-            dic = json.load(f)
+        with open(path, 'rb') as f:
+            if stream:
+                entries = ijson.items(f, K_COLLECTION + '.item')
+            else:
+                entries = orjson.loads(f.read())[K_COLLECTION]
             coll = []
-            for entry in dic[K_COLLECTION]:
+            for entry in entries:
                 t = entry[K_TYPE]
-                assert t in M_T_DES, "DB with unexpected schema: Unknown type {} in collection".format(t)
-                marker = M_T_DES[t](entry[K_DATA])
+                des_fn = M_T_DES.get(t)
+                assert des_fn is not None, "DB with unexpected schema: Unknown type {} in collection".format(t)
+                marker = des_fn(entry[K_DATA])
                 coll.append(marker)
             return Collection(coll)
 
@@ -252,19 +305,33 @@ class InfoRecDB:
 
     def write(self):
         path = pathlib.Path(self._dir) / DATABASE_FILE
-        dic = {}
-        coll = []
-        for marker in self.collection.collection.values():
-            t = type(marker)
-            assert t in M_T_SER, "Collection contains unknown type {}".format(t)
-            entry = {
-                    K_TYPE: M_T_SER[t][1],
-                    K_DATA: M_T_SER[t][0](marker),
-                    }
-            coll.append(entry)
-        dic[K_COLLECTION] = coll
-        with open(path, 'w') as f:
-            json.dump(dic, f)
+        serialisable = []
+        for t, bucket in self.collection.by_type().items():
+            ser = M_T_SER.get(t)
+            assert ser is not None, "Collection contains unknown type {}".format(t)
+            serialisable.append((ser, bucket))
+        # Entries are streamed into a sibling file, which only replaces the DB once complete
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            try:
+                f.write(b'{' + orjson.dumps(K_COLLECTION) + b':[')
+                first = True
+                for (ser_fn, type_tag), bucket in serialisable:
+                    for marker in bucket.values():
+                        entry = {
+                                K_TYPE: type_tag,
+                                K_DATA: ser_fn(marker),
+                                }
+                        if not first:
+                            f.write(b',')
+                        first = False
+                        f.write(orjson.dumps(entry))
+                f.write(b']}')
+            except BaseException:
+                f.close()
+                tmp_path.unlink()
+                raise
+        os.replace(tmp_path, path)
 
 
 class App: